@@ -1,7 +1,7 @@
 import sys
+from functools import lru_cache
 
 import numpy as np
-from tqdm import tqdm
 
 from megalodon import megalodon_helper as mh
 
@@ -10,6 +10,10 @@ DEFAULT_SMOOTH_BW = 0.8
 DEFAULT_SMOOTH_MAX = 200
 DEFAULT_SMOOTH_NVALS = 1001
 DEFAULT_MIN_DENSITY = 5e-6
+# binned kernel density estimate grid values per bandwidth and kernel
+# truncation (in bandwidths)
+KDE_BW_NVALS = 50
+KDE_KERNEL_BWS = 8
 
 SNP_CALIB_TYPE = 'snp_type_indel_len'
 GENERIC_BASE = 'N'
@@ -19,6 +23,14 @@ DEL_CALIB_TMPLT = 'del_{}_calibration'
 DEL_LLR_RNG_TMPLT = 'del_{}_llr_range'
 INS_CALIB_TMPLT = 'ins_{}_calibration'
 INS_LLR_RNG_TMPLT = 'ins_{}_llr_range'
+# stacked SNP calibration format (one array per variant type)
+SNP_TYPES_NAME = 'snp_types'
+SNP_CALIBS_NAME = 'snp_calibrations'
+SNP_LLR_RNGS_NAME = 'snp_llr_ranges'
+DEL_CALIBS_NAME = 'del_calibrations'
+DEL_LLR_RNGS_NAME = 'del_llr_ranges'
+INS_CALIBS_NAME = 'ins_calibrations'
+INS_LLR_RNGS_NAME = 'ins_llr_ranges'
 
 
 ##################################
@@ -53,28 +65,72 @@ def determine_min_dens_edge(
 
 
 
-def compute_smooth_mono_density(llrs, num_calib_vals, smooth_bw, smooth_ls):
-    def guassian(x):
-        return (np.exp(-x ** 2 / (2 * smooth_bw ** 2)) /
-                (smooth_bw * np.sqrt(2 * np.pi)))
+@lru_cache(maxsize=8)
+def precompute_kernel_fft(n_fft, kernel_nvals, step, smooth_bw):
+    """ Compute the FFT of a guassian kernel sampled every step (truncated
+    after kernel_nvals steps on either side). Cached so that the kernel is
+    computed once and shared by all densities evaluated on the same grid.
+    """
+    kernel_offsets = np.arange(kernel_nvals + 1) * step
+    kernel_vals = (np.exp(-kernel_offsets ** 2 / (2 * smooth_bw ** 2)) /
+                   (smooth_bw * np.sqrt(2 * np.pi)))
+    # circular kernel centered at 0 for FFT convolution
+    kernel = np.zeros(n_fft)
+    kernel[:kernel_nvals + 1] = kernel_vals
+    kernel[n_fft - kernel_nvals:] = kernel_vals[1:][::-1]
+    return np.fft.rfft(kernel)
+
+
+def compute_smooth_density(llrs, num_calib_vals, smooth_bw, smooth_ls):
+    """ Compute guassian kernel density estimate of llrs at smooth_ls values.
+
+    LLRs are linearly binned onto a grid finer than smooth_ls (by at least
+    KDE_BW_NVALS values per bandwidth) and convolved with the kernel via
+    FFT, so cost scales with the number of llrs plus grid size instead of
+    their product.
+    """
+    calib_step = (smooth_ls[-1] - smooth_ls[0]) / (num_calib_vals - 1)
+    upsample = max(1, int(np.ceil(calib_step * KDE_BW_NVALS / smooth_bw)))
+    step = calib_step / upsample
+    kernel_nvals = int(np.ceil(KDE_KERNEL_BWS * smooth_bw / step))
+    # pad grid so llrs just outside smooth_ls contribute to edge values
+    n_grid = (num_calib_vals - 1) * upsample + 1 + (2 * kernel_nvals)
+    n_fft = 1 << int(np.ceil(np.log2(n_grid + kernel_nvals)))
+
+    grid_pos = (llrs.astype(np.float64) - smooth_ls[0]) / step + kernel_nvals
+    # drop llrs beyond the kernel truncation (negligible contribution)
+    grid_pos = grid_pos[(grid_pos >= 0) & (grid_pos <= n_grid - 1)]
+    lower_pos = np.minimum(np.floor(grid_pos).astype(int), n_grid - 2)
+    upper_wt = grid_pos - lower_pos
+    binned_llrs = (
+        np.bincount(lower_pos, weights=1 - upper_wt, minlength=n_fft) +
+        np.bincount(lower_pos + 1, weights=upper_wt, minlength=n_fft))
+
+    grid_dens = np.fft.irfft(np.fft.rfft(binned_llrs) * precompute_kernel_fft(
+        n_fft, kernel_nvals, step, smooth_bw), n_fft)
+    smooth_vals = grid_dens[kernel_nvals:n_grid - kernel_nvals:upsample]
+    # remove FFT round off below 0 and normalize in place
+    smooth_vals = np.maximum(smooth_vals, 0)
+    smooth_vals /= llrs.shape[0]
+    return smooth_vals
 
 
-    smooth_vals = np.zeros(num_calib_vals)
-    for llr in tqdm(llrs, smoothing=0, dynamic_ncols=True):
-        smooth_vals += guassian(smooth_ls - llr)
-    smooth_vals /= llrs.shape[0]
+def compute_smooth_mono_density(llrs, num_calib_vals, smooth_bw, smooth_ls):
+    smooth_vals = compute_smooth_density(
+        llrs, num_calib_vals, smooth_bw, smooth_ls)
 
     peak_site = np.argmax(smooth_vals)
     # force monotonic increasing before peak and monotonic decreasing after
-    mono_smooth_vals = np.concatenate([
-        np.mean(np.stack([
-            np.maximum.accumulate(smooth_vals[:peak_site]),
-            np.minimum.accumulate(smooth_vals[:peak_site][::-1])[::-1]]),
-                axis=0),
-        np.mean(np.stack([
-            np.minimum.accumulate(smooth_vals[peak_site:]),
-            np.maximum.accumulate(smooth_vals[peak_site:][::-1])[::-1]]),
-                axis=0)])
+    # (mean of forward and reverse envelopes accumulated in a single buffer)
+    mono_smooth_vals = np.empty_like(smooth_vals)
+    before_peak = mono_smooth_vals[:peak_site]
+    after_peak = mono_smooth_vals[peak_site:]
+    np.maximum.accumulate(smooth_vals[:peak_site], out=before_peak)
+    before_peak += np.minimum.accumulate(
+        smooth_vals[:peak_site][::-1])[::-1]
+    np.minimum.accumulate(smooth_vals[peak_site:], out=after_peak)
+    after_peak += np.maximum.accumulate(smooth_vals[peak_site:][::-1])[::-1]
+    mono_smooth_vals /= 2
 
     return mono_smooth_vals, smooth_vals
 
@@ -117,9 +173,10 @@ def compute_calibration(
     prob_mp = np.argmin(np.abs(prob_alt - 0.5))
     # force monotonic decreasing with reverse maximum before p=0.5 and
     # forward minimum after p=0.5
-    mono_prob = np.concatenate([
-        np.maximum.accumulate(prob_alt[:prob_mp][::-1])[::-1],
-        np.minimum.accumulate(prob_alt[prob_mp:])])
+    mono_prob = np.empty_like(prob_alt)
+    np.maximum.accumulate(
+        prob_alt[:prob_mp][::-1], out=mono_prob[:prob_mp][::-1])
+    np.minimum.accumulate(prob_alt[prob_mp:], out=mono_prob[prob_mp:])
 
     plot_data = None
     if return_plot_info:
@@ -163,9 +220,10 @@ def compute_mirrored_calibration(
     prob_mp = int(np.around(num_calib_vals / 2))
     # force monotonic decreasing with reverse maximum before p=0.5 and
     # forward minimum after p=0.5
-    mono_prob = np.concatenate([
-        np.maximum.accumulate(prob_alt[:prob_mp][::-1])[::-1],
-        np.minimum.accumulate(prob_alt[prob_mp:])])
+    mono_prob = np.empty_like(prob_alt)
+    np.maximum.accumulate(
+        prob_alt[:prob_mp][::-1], out=mono_prob[:prob_mp][::-1])
+    np.minimum.accumulate(prob_alt[prob_mp:], out=mono_prob[prob_mp:])
 
     plot_data = None
     if return_plot_info:
@@ -192,6 +250,69 @@ def compute_log_probs(alt_llrs):
 ###############################
 
 class SnpCalibrator(object):
+    def _add_calib_table(
+            self, llr_ranges, steps, calib_tables, var_type, llr_range,
+            calib_table):
+        llr_ranges[var_type] = llr_range
+        steps[var_type] = (llr_range[1] - llr_range[0]) / (
+            self.num_calib_vals - 1)
+        calib_tables[var_type] = calib_table
+        return
+
+    def _load_stacked_calibration(self, calib_data):
+        """ Load calibration with all SNP types and indel lengths stored in
+        a single stacked array per variant type
+        """
+        for (ref_base, alt_base), snp_llr_range, snp_calib in zip(
+                calib_data[SNP_TYPES_NAME], calib_data[SNP_LLR_RNGS_NAME],
+                calib_data[SNP_CALIBS_NAME]):
+            self._add_calib_table(
+                self.snp_llr_ranges, self.snp_steps, self.snp_calib_tables,
+                (str(ref_base), str(alt_base)), snp_llr_range, snp_calib)
+        # indel arrays are stacked by length starting from 1
+        for indel_len, (del_llr_range, del_calib, ins_llr_range,
+                        ins_calib) in enumerate(zip(
+                            calib_data[DEL_LLR_RNGS_NAME],
+                            calib_data[DEL_CALIBS_NAME],
+                            calib_data[INS_LLR_RNGS_NAME],
+                            calib_data[INS_CALIBS_NAME]), 1):
+            self._add_calib_table(
+                self.del_llr_ranges, self.del_steps, self.del_calib_tables,
+                indel_len, del_llr_range, del_calib)
+            self._add_calib_table(
+                self.ins_llr_ranges, self.ins_steps, self.ins_calib_tables,
+                indel_len, ins_llr_range, ins_calib)
+
+        return
+
+    def _load_template_calibration(self, calib_data):
+        """ Load calibration with one array per SNP type and indel length
+        (named via *_TMPLT values)
+        """
+        # load generic snp and other base combinations
+        snp_types = [(GENERIC_BASE, GENERIC_BASE)] + [
+            (ref_base, alt_base) for ref_base in mh.ALPHABET
+            for alt_base in set(mh.ALPHABET).difference(ref_base)]
+        for ref_base, alt_base in snp_types:
+            self._add_calib_table(
+                self.snp_llr_ranges, self.snp_steps, self.snp_calib_tables,
+                (ref_base, alt_base), calib_data[SNP_LLR_RNG_TMPLT.format(
+                    ref_base, alt_base)].copy(),
+                calib_data[SNP_CALIB_TMPLT.format(ref_base, alt_base)].copy())
+        for indel_len in range(1, self.max_indel_len + 1):
+            self._add_calib_table(
+                self.del_llr_ranges, self.del_steps, self.del_calib_tables,
+                indel_len,
+                calib_data[DEL_LLR_RNG_TMPLT.format(indel_len)].copy(),
+                calib_data[DEL_CALIB_TMPLT.format(indel_len)].copy())
+            self._add_calib_table(
+                self.ins_llr_ranges, self.ins_steps, self.ins_calib_tables,
+                indel_len,
+                calib_data[INS_LLR_RNG_TMPLT.format(indel_len)].copy(),
+                calib_data[INS_CALIB_TMPLT.format(indel_len)].copy())
+
+        return
+
     def _load_calibration(self):
         calib_data = np.load(self.fn)
         self.stratify_type = str(calib_data['stratify_type'])
@@ -204,44 +325,10 @@ class SnpCalibrator(object):
          self.del_llr_ranges, self.del_steps, self.del_calib_tables,
          self.ins_llr_ranges, self.ins_steps, self.ins_calib_tables) = (
              {} for _ in range(9))
-        # load generic snp
-        ref_base, alt_base = GENERIC_BASE, GENERIC_BASE
-        snp_type_llr_range = calib_data[
-            SNP_LLR_RNG_TMPLT.format(ref_base, alt_base)].copy()
-        self.snp_llr_ranges[(ref_base, alt_base)] = snp_type_llr_range
-        self.snp_steps[(ref_base, alt_base)] = (
-            snp_type_llr_range[1] - snp_type_llr_range[0]) / (
-                self.num_calib_vals - 1)
-        self.snp_calib_tables[(ref_base, alt_base)] = calib_data[
-            SNP_CALIB_TMPLT.format(ref_base, alt_base)].copy()
-        # load other base combinations
-        for ref_base in mh.ALPHABET:
-            for alt_base in set(mh.ALPHABET).difference(ref_base):
-                snp_type_llr_range = calib_data[
-                    SNP_LLR_RNG_TMPLT.format(ref_base, alt_base)].copy()
-                self.snp_llr_ranges[(ref_base, alt_base)] = snp_type_llr_range
-                self.snp_steps[(ref_base, alt_base)] = (
-                    snp_type_llr_range[1] - snp_type_llr_range[0]) / (
-                        self.num_calib_vals - 1)
-                self.snp_calib_tables[(ref_base, alt_base)] = calib_data[
-                    SNP_CALIB_TMPLT.format(ref_base, alt_base)].copy()
-        for indel_len in range(1, self.max_indel_len + 1):
-            del_type_llr_range = calib_data[
-                DEL_LLR_RNG_TMPLT.format(indel_len)].copy()
-            self.del_llr_ranges[indel_len] = del_type_llr_range
-            self.del_steps[indel_len] = (
-                del_type_llr_range[1] - del_type_llr_range[0]) / (
-                    self.num_calib_vals - 1)
-            self.del_calib_tables[indel_len] = calib_data[
-                DEL_CALIB_TMPLT.format(indel_len)].copy()
-            ins_type_llr_range = calib_data[
-                INS_LLR_RNG_TMPLT.format(indel_len)].copy()
-            self.ins_llr_ranges[indel_len] = ins_type_llr_range
-            self.ins_steps[indel_len] = (
-                ins_type_llr_range[1] - ins_type_llr_range[0]) / (
-                    self.num_calib_vals - 1)
-            self.ins_calib_tables[indel_len] = calib_data[
-                INS_CALIB_TMPLT.format(indel_len)].copy()
+        if SNP_TYPES_NAME in calib_data.files:
+            self._load_stacked_calibration(calib_data)
+        else:
+            self._load_template_calibration(calib_data)
 
         return
 
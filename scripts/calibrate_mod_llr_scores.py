@@ -1,6 +1,7 @@
 import os
 import sys
 import argparse
+from array import array
 from collections import defaultdict
 
 import matplotlib
@@ -14,6 +15,9 @@ import numpy as np
 from megalodon import calibration
 
 
+LLR_READ_BUFFER_SIZE = 1 << 20
+
+
 def plot_calib(
         pdf_fp, mod_base, smooth_ls, s_ref, sm_ref, s_alt, sm_alt,
         mono_prob, prob_alt):
@@ -41,18 +45,24 @@ def plot_calib(
     return
 
 def extract_llrs(llr_fn):
-    mod_base_llrs = defaultdict(lambda: ([], []))
-    with open(llr_fn) as llr_fp:
+    # accumulate into compact typed arrays instead of lists of float objects
+    mod_base_llrs = defaultdict(lambda: (array('d'), array('d')))
+    # read raw bytes with a large buffer (float accepts bytes) and only
+    # decode the few distinct mod bases
+    with open(llr_fn, 'rb', buffering=LLR_READ_BUFFER_SIZE) as llr_fp:
         for line in llr_fp:
             is_mod, llr, mod_base = line.split()
             llr = float(llr)
             if np.isnan(llr): continue
-            if is_mod == 'True':
+            if is_mod == b'True':
                 mod_base_llrs[mod_base][0].append(llr)
             else:
                 mod_base_llrs[mod_base][1].append(llr)
 
-    return mod_base_llrs
+    return dict(
+        (mod_base.decode(), (np.frombuffer(mod_llrs, dtype=np.float64),
+                             np.frombuffer(can_llrs, dtype=np.float64)))
+        for mod_base, (mod_llrs, can_llrs) in mod_base_llrs.items())
 
 
 def prep_out(out_fn, overwrite):
@@ -125,7 +135,7 @@ def main():
         sys.stderr.write(
             'Computing {} modified base calibration.\n'.format(mod_base))
         mod_calib, mod_llr_range, plot_data = calibration.compute_calibration(
-            np.array(can_llrs), np.array(mod_llrs), args.max_input_llr,
+            can_llrs, mod_llrs, args.max_input_llr,
             args.num_calibration_values, args.smooth_bandwidth,
             args.min_density, pdf_fp is not None)
         save_kwargs[mod_base + '_llr_range'] = mod_llr_range
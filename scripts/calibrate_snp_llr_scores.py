@@ -1,15 +1,10 @@
 import os
 import sys
 import argparse
-from collections import defaultdict
-
-import matplotlib
-if sys.platform == 'darwin':
-    matplotlib.use("TkAgg")
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
+import multiprocessing as mp
 
 import numpy as np
+import pandas as pd
 
 from megalodon import calibration
 
@@ -17,6 +12,7 @@ from megalodon import calibration
 def plot_calib(
         pdf_fp, snp_type, smooth_ls, s_ref, sm_ref, s_alt, sm_alt,
         mono_prob, prob_alt):
+    import matplotlib.pyplot as plt
     f, axarr = plt.subplots(3, sharex=True, figsize=(11, 7))
     axarr[0].plot(smooth_ls, s_ref, color='orange')
     axarr[0].plot(smooth_ls, sm_ref, color='red')
@@ -40,29 +36,65 @@ def plot_calib(
     plt.close()
     return
 
+def group_llrs(group_keys, llrs):
+    """ Split llrs into a contiguous array for each unique group key with a
+    single sort (preserving the input order within each group). Returned
+    dict is in sorted key order.
+    """
+    uniq_keys, key_inds = np.unique(group_keys, return_inverse=True)
+    split_llrs = np.split(
+        llrs[np.argsort(key_inds, kind='stable')],
+        np.cumsum(np.bincount(key_inds, minlength=uniq_keys.shape[0]))[:-1])
+    return dict(zip(uniq_keys.tolist(), split_llrs))
+
+
 def extract_llrs(llr_fn, max_indel_len=None):
-    snp_ref_llrs, ins_ref_llrs, del_ref_llrs = (
-        defaultdict(list) for _ in range(3))
-    with open(llr_fn) as llr_fp:
-        for line in llr_fp:
-            is_ref_correct, llr, ref_seq, alt_seq = line.split()
-            llr = float(llr)
-            if is_ref_correct != 'True': continue
-            if np.isnan(llr): continue
-            if (max_indel_len is not None and
-                np.abs(len(ref_seq) - len(alt_seq)) > max_indel_len):
-                continue
-            if len(ref_seq) == 1 and len(alt_seq) == 1:
-                snp_ref_llrs[(ref_seq, alt_seq)].append(llr)
-            else:
-                if len(ref_seq) > len(alt_seq):
-                    del_ref_llrs[len(ref_seq) - len(alt_seq)].append(llr)
-                else:
-                    ins_ref_llrs[len(alt_seq) - len(ref_seq)].append(llr)
+    # parse memory-mapped file with the pandas C parser; only nan llr values
+    # are treated as missing so sequences are never converted. llrs are
+    # stored as contiguous float32 arrays to reduce memory for large inputs
+    llrs_dat = pd.read_csv(
+        llr_fn, sep='\t', header=None, engine='c', memory_map=True,
+        names=['is_ref_correct', 'llr', 'ref_seq', 'alt_seq'],
+        dtype={'is_ref_correct': str, 'llr': np.float32,
+               'ref_seq': str, 'alt_seq': str},
+        keep_default_na=False, na_values={'llr': ['nan']})
+    llrs_dat = llrs_dat[(llrs_dat.is_ref_correct == 'True') &
+                        ~np.isnan(llrs_dat.llr)]
+    ref_lens = llrs_dat.ref_seq.str.len().values
+    alt_lens = llrs_dat.alt_seq.str.len().values
+    len_diffs = ref_lens - alt_lens
+    if max_indel_len is not None:
+        valid_len = np.abs(len_diffs) <= max_indel_len
+        llrs_dat = llrs_dat[valid_len]
+        ref_lens, alt_lens, len_diffs = (
+            ref_lens[valid_len], alt_lens[valid_len], len_diffs[valid_len])
+    is_snp = (ref_lens == 1) & (alt_lens == 1)
+    is_del = ~is_snp & (len_diffs > 0)
+    is_ins = ~is_snp & (len_diffs <= 0)
+
+    llrs = llrs_dat.llr.values
+    # encode single base SNPs as integer (ref byte, alt byte) keys for fast
+    # grouping and only decode the few distinct keys
+    snp_dat = llrs_dat[is_snp]
+    ref_bytes, alt_bytes = (
+        np.frombuffer(''.join(seqs).encode(), dtype=np.uint8).astype(np.uint16)
+        for seqs in (snp_dat.ref_seq, snp_dat.alt_seq))
+    snp_keys = (ref_bytes << 8) | alt_bytes
+    snp_ref_llrs = dict(
+        ((chr(snp_key >> 8), chr(snp_key & 0xff)), snp_llrs)
+        for snp_key, snp_llrs in group_llrs(snp_keys, llrs[is_snp]).items())
+    del_ref_llrs = group_llrs(len_diffs[is_del], llrs[is_del])
+    ins_ref_llrs = group_llrs(-len_diffs[is_ins], llrs[is_ins])
 
     return snp_ref_llrs, ins_ref_llrs, del_ref_llrs
 
 
+def _compute_calib_worker(stratum_args):
+    stratum_name, *calib_args = stratum_args
+    sys.stderr.write('Computing ' + stratum_name + ' calibration.\n')
+    return calibration.compute_mirrored_calibration(*calib_args)
+
+
 def prep_out(out_fn, overwrite):
     if os.path.exists(out_fn):
         if overwrite:
@@ -115,6 +147,9 @@ def get_parser():
     parser.add_argument(
         '--overwrite', action='store_true',
         help='Overwrite --out-filename if it exists.')
+    parser.add_argument(
+        '--processes', type=int, default=1,
+        help='Number of parallel processes. Default: %(default)d')
 
     return parser
 
@@ -129,96 +164,100 @@ def main():
         args.ground_truth_llrs)
     # add calibration for a generic SNP (mostly multiple SNPs
     # as single variant; but not an indel)
-    generic_snp_llrs = [llr for snp_type_llrs in snp_ref_llrs.values()
-                        for llr in snp_type_llrs]
-    # downsample to same level as other snp types
+    generic_snp_llrs = np.concatenate(list(snp_ref_llrs.values()))
+    # downsample to same level as other snp types (select indices without
+    # shuffling the full set of llrs)
+    rng = np.random.default_rng()
     snp_ref_llrs[
         (calibration.GENERIC_BASE,
-         calibration.GENERIC_BASE)] = np.random.choice(
-             generic_snp_llrs, int(len(generic_snp_llrs) / 12), replace=False)
+         calibration.GENERIC_BASE)] = generic_snp_llrs[rng.choice(
+             generic_snp_llrs.shape[0], generic_snp_llrs.shape[0] // 12,
+             replace=False, shuffle=False)]
     max_indel_len = max(ins_ref_llrs)
     assert set(ins_ref_llrs) == set(del_ref_llrs), (
             'Must test same range of lengths for insertions and deletions')
     assert set(ins_ref_llrs) == set(range(1, max_indel_len + 1)), (
         'Must test every length in length range for indels')
 
-    pdf_fp = None if args.out_pdf is None else PdfPages(args.out_pdf)
-    sys.stderr.write('Computing stratified single-base SNP calibration.\n')
-    snp_calibs = {}
-    for (ref_seq, alt_seq), snp_llrs in sorted(snp_ref_llrs.items()):
-        sys.stderr.write('Computing ' + ref_seq + ' -> ' + alt_seq +
-                         ' SNP calibration.\n')
-        snp_calib, snp_llr_range, plot_data \
-            = calibration.compute_mirrored_calibration(
-                np.array(snp_llrs), args.max_input_llr,
-                args.num_calibration_values, args.smooth_bandwidth,
-                args.min_density, pdf_fp is not None)
-        snp_calibs[(ref_seq, alt_seq)] = (snp_calib, snp_llr_range)
-        if pdf_fp is not None:
-            plot_calib(pdf_fp, 'SNP: ' + ref_seq + ' -> ' + alt_seq, *plot_data)
-    sys.stderr.write('Computing deletion calibration.\n')
-    del_calibs = {}
-    for del_len, del_llrs in sorted(del_ref_llrs.items()):
-        sys.stderr.write('Computing deletion length {} calibration.\n'.format(
-            del_len))
-        del_calib, del_llr_range, plot_data \
-            = calibration.compute_mirrored_calibration(
-                np.array(del_llrs), args.max_input_llr,
-                args.num_calibration_values, args.smooth_bandwidth,
-                args.min_density, pdf_fp is not None)
-        del_calibs[del_len] = (del_calib, del_llr_range)
-        if pdf_fp is not None:
-            plot_calib(pdf_fp, 'Deletion Length ' + str(del_len), *plot_data)
-    sys.stderr.write('Computing insertion calibration.\n')
-    ins_calibs = {}
-    for ins_len, ins_llrs in sorted(ins_ref_llrs.items()):
-        sys.stderr.write('Computing insertion length {} calibration.\n'.format(
-            ins_len))
-        ins_calib, ins_llr_range, plot_data \
-            = calibration.compute_mirrored_calibration(
-                np.array(ins_llrs), args.max_input_llr,
-                args.num_calibration_values, args.smooth_bandwidth,
-                args.min_density, pdf_fp is not None)
-        ins_calibs[ins_len] = (ins_calib, ins_llr_range)
-        if pdf_fp is not None:
-            plot_calib(pdf_fp, 'Insertion Length ' + str(ins_len), *plot_data)
-
-    if pdf_fp is not None:
+    do_plot = args.out_pdf is not None
+    pdf_fp = None
+    if do_plot:
+        # only load matplotlib when plots are requested; plots are only
+        # written to file so use the non-interactive backend
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib.backends.backend_pdf import PdfPages
+        pdf_fp = PdfPages(args.out_pdf)
+    snp_calibs, del_calibs, ins_calibs = {}, {}, {}
+    # each stratum is computed independently so distribute over processes
+    # and collect results (and write plots) in the main process. llr dicts
+    # are already in sorted key order (with the generic SNP type last)
+    calib_strata = []
+    for (ref_seq, alt_seq), snp_llrs in snp_ref_llrs.items():
+        calib_strata.append((
+            snp_calibs, (ref_seq, alt_seq),
+            'SNP: ' + ref_seq + ' -> ' + alt_seq, snp_llrs))
+    for del_len, del_llrs in del_ref_llrs.items():
+        calib_strata.append((
+            del_calibs, del_len, 'Deletion Length ' + str(del_len), del_llrs))
+    for ins_len, ins_llrs in ins_ref_llrs.items():
+        calib_strata.append((
+            ins_calibs, ins_len, 'Insertion Length ' + str(ins_len), ins_llrs))
+    calib_args = [
+        (stratum_name, stratum_llrs, args.max_input_llr,
+         args.num_calibration_values, args.smooth_bandwidth,
+         args.min_density, do_plot)
+        for _, _, stratum_name, stratum_llrs in calib_strata]
+    sys.stderr.write('Computing stratified SNP and indel calibration.\n')
+    calib_pool = mp.Pool(args.processes) if args.processes > 1 else None
+    try:
+        calib_results = (
+            map(_compute_calib_worker, calib_args) if calib_pool is None else
+            calib_pool.imap(_compute_calib_worker, calib_args))
+        # results are returned lazily in stratum order, so pages are written
+        # (in a deterministic order) while later strata are still computed
+        for (stratum_calibs, stratum_key, stratum_name, _), (
+                stratum_calib, stratum_llr_range, plot_data) in zip(
+                    calib_strata, calib_results):
+            stratum_calibs[stratum_key] = (stratum_calib, stratum_llr_range)
+            if do_plot:
+                plot_calib(pdf_fp, stratum_name, *plot_data)
+    finally:
+        # as with Pool.__exit__, stop workers (all results have been
+        # consumed unless an error was raised)
+        if calib_pool is not None:
+            calib_pool.terminate()
+            calib_pool.join()
+
+    if do_plot:
         pdf_fp.close()
 
     # save calibration table for reading into SNP table
     sys.stderr.write('Saving calibrations to file.\n')
-    snp_llr_range_save_data, snp_calib_save_data = {}, {}
-    for (ref_seq, alt_seq), (snp_calib, snp_llr_range) in snp_calibs.items():
-        snp_calib_save_data[
-            calibration.SNP_CALIB_TMPLT.format(ref_seq, alt_seq)] = snp_calib
-        snp_llr_range_save_data[
-            calibration.SNP_LLR_RNG_TMPLT.format(
-                ref_seq, alt_seq)] = snp_llr_range
-    del_llr_range_save_data, del_calib_save_data = {}, {}
-    for del_len, (del_calib, del_llr_range) in del_calibs.items():
-        del_calib_save_data[
-            calibration.DEL_CALIB_TMPLT.format(del_len)] = del_calib
-        del_llr_range_save_data[
-            calibration.DEL_LLR_RNG_TMPLT.format(del_len)] = del_llr_range
-    ins_llr_range_save_data, ins_calib_save_data = {}, {}
-    for ins_len, (ins_calib, ins_llr_range) in ins_calibs.items():
-        ins_calib_save_data[
-            calibration.INS_CALIB_TMPLT.format(ins_len)] = ins_calib
-        ins_llr_range_save_data[
-            calibration.INS_LLR_RNG_TMPLT.format(ins_len)] = ins_llr_range
-    np.savez(
+    # stack all strata for each variant type into a single array (indels
+    # stacked by length from 1 to max_indel_len)
+    snp_types = sorted(snp_calibs)
+    indel_lens = range(1, max_indel_len + 1)
+    save_data = {
+        calibration.SNP_TYPES_NAME: np.array(snp_types, dtype='U1'),
+        calibration.SNP_CALIBS_NAME: np.stack([
+            snp_calibs[snp_type][0] for snp_type in snp_types]),
+        calibration.SNP_LLR_RNGS_NAME: np.stack([
+            snp_calibs[snp_type][1] for snp_type in snp_types]),
+        calibration.DEL_CALIBS_NAME: np.stack([
+            del_calibs[del_len][0] for del_len in indel_lens]),
+        calibration.DEL_LLR_RNGS_NAME: np.stack([
+            del_calibs[del_len][1] for del_len in indel_lens]),
+        calibration.INS_CALIBS_NAME: np.stack([
+            ins_calibs[ins_len][0] for ins_len in indel_lens]),
+        calibration.INS_LLR_RNGS_NAME: np.stack([
+            ins_calibs[ins_len][1] for ins_len in indel_lens])}
+    np.savez_compressed(
         args.out_filename,
         stratify_type=calibration.SNP_CALIB_TYPE,
         smooth_nvals=args.num_calibration_values,
         max_indel_len=max_indel_len,
-        **snp_calib_save_data,
-        **snp_llr_range_save_data,
-        **del_calib_save_data,
-        **del_llr_range_save_data,
-        **ins_calib_save_data,
-        **ins_llr_range_save_data
-    )
+        **save_data)
 
     return
 
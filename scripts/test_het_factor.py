@@ -1,3 +1,4 @@
+import os
 import sys
 import argparse
 from collections import defaultdict
@@ -9,6 +10,8 @@ import numpy as np
 HOM_REF_TXT = 'hom_ref'
 HET_TXT = 'het'
 HOM_ALT_TXT = 'hom_alt'
+GT_TXTS = (HOM_REF_TXT, HET_TXT, HOM_ALT_TXT)
+HOM_REF_CODE, HET_CODE, HOM_ALT_CODE = range(len(GT_TXTS))
 
 SNP_TXT = 'SNP'
 DEL_TXT = 'DEL'
@@ -51,90 +54,110 @@ def get_parser():
     parser.add_argument(
         'megalodon_variants', default='megalodon_results/variants.vcf',
         help='VCF file containing diploid variant calls from megalodon.')
+    parser.add_argument(
+        '--threads', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+        help='Number of htslib threads used to decompress each VCF. ' +
+        'Default: %(default)d')
 
     return parser
 
 
-def main():
-    def conv_call_str(gt_vals):
-        gt_set = set(gt_vals)
-        if gt_set == set([0]):
-            return HOM_REF_TXT
-        elif gt_set == set([0, 1]):
-            return HET_TXT
-        return HOM_ALT_TXT
+def get_gt_inds(gt_vals):
+    """ Return allele indices from a GT field (missing alleles encoded as -1)
+    """
+    return [-1 if gt_val is None else gt_val for gt_val in gt_vals] or [-1]
 
-    args = get_parser().parse_args()
 
-    gt_calls = defaultdict(dict)
-    for variant in pysam.VariantFile(args.ground_truth_variants).fetch():
+def stack_gt_inds(type_gt_inds):
+    """ Stack allele indices (from get_gt_inds) with any ploidy into an array.
+    Shorter genotypes are padded by repeating their first allele so that
+    the set of alleles (and so min/max) for each genotype is unchanged.
+    """
+    max_ploidy = max(map(len, type_gt_inds))
+    return np.array([
+        gt_inds + gt_inds[:1] * (max_ploidy - len(gt_inds))
+        for gt_inds in type_gt_inds], dtype=np.int8)
+
+
+def conv_call_codes(gt_inds):
+    """ Classify all genotypes at once from an array of allele indices (as
+    from stack_gt_inds) into hom ref, het or hom alt codes
+    """
+    gt_min, gt_max = gt_inds.min(axis=1), gt_inds.max(axis=1)
+    return np.where(
+        (gt_min == 0) & (gt_max == 0), HOM_REF_CODE, np.where(
+            (gt_min == 0) & (gt_max == 1), HET_CODE, HOM_ALT_CODE))
+
+
+def parse_vcf_calls(vcf_fn, threads=1):
+    var_keys, var_gt_inds = defaultdict(list), defaultdict(list)
+    for variant in pysam.VariantFile(vcf_fn, threads=threads).fetch():
         # skip mutli-allelic sites
         if variant.alts is None or len(variant.alts) > 1: continue
-        if len(variant.ref) == len(variant.alts[0]):
-            gt_calls[SNP_TXT][(variant.contig, variant.pos, variant.ref,
-                               variant.alts[0])] = conv_call_str(
-                                   variant.samples.values()[0]['GT'])
-        elif len(variant.ref) > len(variant.alts[0]):
-            gt_calls[DEL_TXT][(variant.contig, variant.pos, variant.ref,
-                               variant.alts[0])] = conv_call_str(
-                                   variant.samples.values()[0]['GT'])
-        else:
-            gt_calls[INS_TXT][(variant.contig, variant.pos, variant.ref,
-                               variant.alts[0])] = conv_call_str(
-                                   variant.samples.values()[0]['GT'])
-    mega_calls = defaultdict(dict)
-    for variant in pysam.VariantFile(args.megalodon_variants).fetch():
-        # skip mutli-allelic sites
-        if len(variant.alts) > 1: continue
-        if len(variant.ref) == len(variant.alts[0]):
-            mega_calls[SNP_TXT][(variant.contig, variant.pos, variant.ref,
-                                 variant.alts[0])] = conv_call_str(
-                                     variant.samples.values()[0]['GT'])
-        elif len(variant.ref) > len(variant.alts[0]):
-            mega_calls[DEL_TXT][(variant.contig, variant.pos, variant.ref,
-                                 variant.alts[0])] = conv_call_str(
-                                     variant.samples.values()[0]['GT'])
-        else:
-            mega_calls[INS_TXT][(variant.contig, variant.pos, variant.ref,
-                                 variant.alts[0])] = conv_call_str(
-                                     variant.samples.values()[0]['GT'])
+        ref, alt = variant.ref, variant.alts[0]
+        var_type = (SNP_TXT if len(ref) == len(alt) else (
+            DEL_TXT if len(ref) > len(alt) else INS_TXT))
+        var_keys[var_type].append((variant.contig, variant.pos, ref, alt))
+        # access first sample by index to avoid building all sample records
+        var_gt_inds[var_type].append(get_gt_inds(
+            variant.samples[0].allele_indices))
+
+    calls = defaultdict(dict)
+    for var_type, type_keys in var_keys.items():
+        calls[var_type] = dict(zip(type_keys, conv_call_codes(
+            stack_gt_inds(var_gt_inds[var_type]))))
+
+    return calls
+
+
+def main():
+    args = get_parser().parse_args()
+
+    gt_calls = parse_vcf_calls(args.ground_truth_variants, args.threads)
+    mega_calls = parse_vcf_calls(args.megalodon_variants, args.threads)
 
     for var_type in (SNP_TXT, DEL_TXT, INS_TXT):
-        counts = defaultdict(int)
-        for chrm_pos_ref_alt in set(gt_calls[var_type]).intersection(
-                mega_calls[var_type]):
-            counts[(gt_calls[var_type][chrm_pos_ref_alt],
-                    mega_calls[var_type][chrm_pos_ref_alt])] += 1
-
-        # compute F1 stat
-        vt_stats = []
-        for truth_type in (HOM_REF_TXT, HET_TXT, HOM_ALT_TXT):
-            gt_count = sum(
-                counts[(truth_type, mega_call)]
-                for mega_call in (HOM_REF_TXT, HET_TXT, HOM_ALT_TXT))
-            mega_count = sum(
-                counts[(gt_call, truth_type)]
-                for gt_call in (HOM_REF_TXT, HET_TXT, HOM_ALT_TXT))
-            if gt_count == 0 or mega_count == 0:
-                vt_stats.append((np.NAN, np.NAN, np.NAN))
-            else:
-                prec = counts[(truth_type, truth_type)] / mega_count
-                recall = counts[(truth_type, truth_type)] / gt_count
-                vt_stats.append((
-                    2 * (prec * recall) / (prec + recall), prec, recall))
+        # join calls by probing the larger table with each key of the smaller
+        gt_type_calls = gt_calls[var_type]
+        mega_type_calls = mega_calls[var_type]
+        swap_tables = len(mega_type_calls) < len(gt_type_calls)
+        probe_calls, build_calls = (
+            (mega_type_calls, gt_type_calls) if swap_tables else
+            (gt_type_calls, mega_type_calls))
+        probe_codes, build_codes = [], []
+        for chrm_pos_ref_alt, probe_code in probe_calls.items():
+            build_code = build_calls.get(chrm_pos_ref_alt)
+            if build_code is not None:
+                probe_codes.append(probe_code)
+                build_codes.append(build_code)
+        gt_codes, mega_codes = (
+            np.array(codes, dtype=int) for codes in (
+                (build_codes, probe_codes) if swap_tables else
+                (probe_codes, build_codes)))
+        # confusion matrix with truth rows and megalodon call columns
+        counts = np.bincount(
+            gt_codes * len(GT_TXTS) + mega_codes,
+            minlength=len(GT_TXTS) ** 2).reshape(len(GT_TXTS), len(GT_TXTS))
+
+        # compute F1 stat for each genotype from confusion matrix sums
+        true_counts = np.diag(counts)
+        gt_counts, mega_counts = counts.sum(axis=1), counts.sum(axis=0)
+        valid_counts = (gt_counts > 0) & (mega_counts > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prec = np.where(valid_counts, true_counts / mega_counts, np.nan)
+            recall = np.where(valid_counts, true_counts / gt_counts, np.nan)
+            f1 = 2 * (prec * recall) / (prec + recall)
+        vt_stats = np.column_stack([f1, prec, recall])
 
         # print output
         sys.stdout.write(var_type + '\n')
         sys.stdout.write(HEADER_TMPLT.format('Truth\Calls', *STAT_NAMES))
-        for truth, (f1, prec, recall) in zip(
-                (HOM_REF_TXT, HET_TXT, HOM_ALT_TXT),
-                vt_stats):
+        for truth_code, (f1, prec, recall) in enumerate(vt_stats):
             sys.stdout.write(STATS_TMPLT.format(
-                truth, counts[(truth, HOM_REF_TXT)], counts[(truth, HET_TXT)],
-                counts[(truth, HOM_ALT_TXT)], f1, prec, recall))
+                GT_TXTS[truth_code], *counts[truth_code], f1, prec, recall))
         mean_f1_fmt = ('{:>' + str(STAT_WIDTH * (N_STATS - 2)) + '}' +
                        FLOAT_FMT_STR * N_FLOAT_STATS + '\n')
-        mean_stats = map(np.nanmean, zip(*vt_stats))
+        mean_stats = np.nanmean(vt_stats, axis=0)
         sys.stdout.write(mean_f1_fmt.format('Mean Stats:   ', *mean_stats))
         sys.stdout.write('\n')
 